@@ -6,6 +6,7 @@ from fastapi_utils.tasks import repeat_every
 from pydantic import BaseModel
 
 from . import model
+from .db import engine
 from .model import (
     JoinRoomResult,
     LiveDifficulty,
@@ -29,7 +30,12 @@ async def root():
 @app.on_event("startup")
 @repeat_every(seconds=5)
 async def leave_expired_member_task():
-    model.leave_expired_member()
+    await model.leave_expired_member()
+
+
+@app.on_event("shutdown")
+async def dispose_engine():
+    await engine.dispose()
 
 
 # User APIs
@@ -45,16 +51,16 @@ class UserCreateResponse(BaseModel):
 
 
 @app.post("/user/create", response_model=UserCreateResponse)
-def user_create(req: UserCreateRequest):
+async def user_create(req: UserCreateRequest):
     """新規ユーザー作成"""
-    token = model.create_user(req.user_name, req.leader_card_id)
+    token = await model.create_user(req.user_name, req.leader_card_id)
     return UserCreateResponse(user_token=token)
 
 
 bearer = HTTPBearer()
 
 
-def get_auth_token(cred: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
+async def get_auth_token(cred: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
     assert cred is not None
     if not cred.credentials:
         raise HTTPException(status_code=401, detail="invalid credential")
@@ -62,8 +68,8 @@ def get_auth_token(cred: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
 
 
 @app.get("/user/me", response_model=SafeUser)
-def user_me(token: str = Depends(get_auth_token)):
-    user = model.get_user_by_token(token)
+async def user_me(token: str = Depends(get_auth_token)):
+    user = await model.get_user_by_token(token)
     if user is None:
         raise HTTPException(status_code=404)
     # print(f"user_me({token=}, {user=})")
@@ -75,10 +81,10 @@ class Empty(BaseModel):
 
 
 @app.post("/user/update", response_model=Empty)
-def user_update(req: UserCreateRequest, token: str = Depends(get_auth_token)):
+async def user_update(req: UserCreateRequest, token: str = Depends(get_auth_token)):
     """Update user attributes"""
     # print(req)
-    model.update_user(token, req.user_name, req.leader_card_id)
+    await model.update_user(token, req.user_name, req.leader_card_id)
     return Empty()
 
 
@@ -95,9 +101,9 @@ class RoomCreateResponse(BaseModel):
 
 
 @app.post("/room/create", response_model=RoomCreateResponse)
-def room_create(req: RoomCreateRequest, token: str = Depends(get_auth_token)):
+async def room_create(req: RoomCreateRequest, token: str = Depends(get_auth_token)):
     """ルーム作成リクエスト"""
-    room_id = model.create_room(token, req.live_id, req.select_difficulty)
+    room_id = await model.create_room(token, req.live_id, req.select_difficulty)
     return RoomCreateResponse(room_id=room_id)
 
 
@@ -110,10 +116,10 @@ class RoomListResponse(BaseModel):
 
 
 @app.post("/room/list", response_model=RoomListResponse)
-def room_list(req: RoomListRequest, token: str = Depends(get_auth_token)):
+async def room_list(req: RoomListRequest, token: str = Depends(get_auth_token)):
     """入場可能なルーム一覧を取得"""
     live_id = req.live_id
-    room_info_list = model.get_room_info_list(token, live_id)
+    room_info_list = await model.get_room_info_list(token, live_id)
     return RoomListResponse(room_info_list=room_info_list)
 
 
@@ -127,9 +133,9 @@ class RoomJoinResponse(BaseModel):
 
 
 @app.post("/room/join", response_model=RoomJoinResponse)
-def room_join(req: RoomJoinRequest, token: str = Depends(get_auth_token)):
+async def room_join(req: RoomJoinRequest, token: str = Depends(get_auth_token)):
     """ルーム入場リクエスト"""
-    join_room_result = model.join_room(token, req.room_id, req.select_difficulty)
+    join_room_result = await model.join_room(token, req.room_id, req.select_difficulty)
     return RoomJoinResponse(join_room_result=join_room_result)
 
 
@@ -143,9 +149,9 @@ class RoomWaitResponse(BaseModel):
 
 
 @app.post("/room/wait", response_model=RoomWaitResponse)
-def room_wait(req: RoomWaitRequest, token: str = Depends(get_auth_token)):
+async def room_wait(req: RoomWaitRequest, token: str = Depends(get_auth_token)):
     """４人集まるのを待つ（ポーリング）。APIの結果でゲーム開始がわかる"""
-    status, room_user_list = model.get_room_wait_status(token, req.room_id)
+    status, room_user_list = await model.get_room_wait_status(token, req.room_id)
     print(RoomWaitResponse(status=status, room_user_list=room_user_list).json())
     return RoomWaitResponse(status=status, room_user_list=room_user_list)
 
@@ -155,9 +161,9 @@ class RoomStartRequest(BaseModel):
 
 
 @app.post("/room/start", response_model=Empty)
-def room_start(req: RoomStartRequest, token: str = Depends(get_auth_token)):
+async def room_start(req: RoomStartRequest, token: str = Depends(get_auth_token)):
     """ルームのライブ開始リクエスト。部屋のオーナーが叩く"""
-    model.start_room(token, req.room_id)
+    await model.start_room(token, req.room_id)
     return Empty()
 
 
@@ -168,9 +174,9 @@ class RoomEndtRequest(BaseModel):
 
 
 @app.post("/room/end", response_model=Empty)
-def room_end(req: RoomEndtRequest, token: str = Depends(get_auth_token)):
+async def room_end(req: RoomEndtRequest, token: str = Depends(get_auth_token)):
     """ルームのライブ終了時リクエスト。ゲームが終わったら各人が叩く。"""
-    model.end_room(token, req.room_id, req.judge_count_list, req.score)
+    await model.end_room(token, req.room_id, req.judge_count_list, req.score)
     return Empty()
 
 
@@ -183,9 +189,9 @@ class RoomResultResponse(BaseModel):
 
 
 @app.post("/room/result", response_model=RoomResultResponse)
-def room_result(req: RoomResultRequest, token: str = Depends(get_auth_token)):
+async def room_result(req: RoomResultRequest, token: str = Depends(get_auth_token)):
     """ルームのライブ終了後。end 叩いたあとにこれをポーリングする。 クライアントはn秒間隔で投げる想定。"""
-    result_user_list = model.get_room_result(token, req.room_id)
+    result_user_list = await model.get_room_result(token, req.room_id)
     rr = RoomResultResponse(result_user_list=result_user_list)
     return rr
 
@@ -195,7 +201,7 @@ class RoomLeaveRequest(BaseModel):
 
 
 @app.post("/room/leave", response_model=Empty)
-def room_start(req: RoomLeaveRequest, token: str = Depends(get_auth_token)):
+async def room_start(req: RoomLeaveRequest, token: str = Depends(get_auth_token)):
     """ルーム退出リクエスト。オーナーも /room/join で参加した参加者も実行できる"""
-    model.leave_room(token, req.room_id)
+    await model.leave_room(token, req.room_id)
     return Empty()
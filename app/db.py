@@ -1,5 +1,12 @@
-from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
 
 from . import config
 
-engine = create_engine(config.DATABASE_URI, future=True, echo=True)
+engine = create_async_engine(
+    config.DATABASE_URI,
+    echo=True,
+    pool_size=20,
+    max_overflow=10,
+    pool_recycle=3600,
+    pool_pre_ping=True,
+)
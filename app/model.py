@@ -1,23 +1,150 @@
-import json
+import threading
 import uuid
-from datetime import datetime, timedelta
-from enum import Enum, IntEnum
-from typing import Optional, Union
-
+from collections import Counter
+from datetime import timedelta
+from enum import IntEnum
+from typing import Optional
+
+import orjson
+from asyncmy.constants import ER
+from cachetools import TTLCache
 from fastapi import HTTPException
-from pydantic import BaseModel, Json
-from sqlalchemy import text
-from sqlalchemy.engine import Connection
-from sqlalchemy.exc import NoResultFound
+from pydantic import BaseModel
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import IntegrityError, NoResultFound
+from sqlalchemy.ext.asyncio import AsyncConnection
 
 from .config import TTL_LIVE_INTERVAL, TTL_POLLING_INTERVAL
 from .db import engine
 
+# SQL
+# NOTE: text() は呼び出し毎に生成せず、モジュールレベルで使い回す.
+_SQL_INSERT_USER = text(
+    "INSERT INTO `user` (`name`, `token`, `leader_card_id`) VALUES (:name, :token, :leader_card_id)"
+)
+_SQL_GET_USER_BY_TOKEN = text(
+    "SELECT `id`, `name`, `leader_card_id` FROM `user` WHERE `token`=:token"
+)
+_SQL_UPDATE_USER = text(
+    "UPDATE `user` SET `name`=:name, `leader_card_id`=:leader_card_id WHERE `token`=:token"
+)
+_SQL_GET_OTHER_ROOM_ID = text(
+    "SELECT `room_id` FROM `room_member` WHERE `user_id`=:user_id and `room_id`!=:room_id"
+)
+_SQL_GET_EXPIRED_MEMBER = text(
+    "SELECT `id`, `room_id` FROM `room_member` WHERE `ttl` < NOW() LIMIT :limit FOR UPDATE"
+)
+_SQL_DELETE_ROOM_MEMBER_BY_ID = text(
+    "DELETE FROM `room_member` WHERE `id` IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+_SQL_TRANSFER_HOST_ALL = text(
+    "UPDATE `room_member` INNER JOIN "
+    "(SELECT MIN(`id`) as `id` FROM `room_member` GROUP BY `room_id` HAVING MAX(`is_host`)=false) as `host` "
+    "ON `host`.`id`=`room_member`.`id` SET `room_member`.`is_host`=true"
+)
+_SQL_UPDATE_TTL_USER = text(
+    "UPDATE `room_member` SET `ttl`=ADDTIME(NOW(), :time) "
+    "WHERE `user_id`=:user_id and `room_id`=:room_id"
+)
+_SQL_INCREMENT_JOINED_USER_COUNT = text(
+    "UPDATE `room` SET `joined_user_count`=`joined_user_count`+1 "
+    "WHERE `id`=:room_id and `wait_room_status`=:wait and `joined_user_count`<`max_user_count`"
+)
+_SQL_GET_ROOM_CAPACITY = text(
+    "SELECT `joined_user_count`, `max_user_count`, `wait_room_status`, "
+    "EXISTS(SELECT 1 FROM `room_member` WHERE `user_id`=:user_id and `room_id`=:room_id) as `is_member` "
+    "FROM `room` WHERE `id`=:room_id"
+)
+_SQL_INSERT_ROOM_MEMBER = text(
+    "INSERT INTO `room_member` (`user_id`, `room_id`, `select_difficulty`, `is_host`, `ttl`) "
+    "VALUES (:user_id, :room_id, :select_difficulty, :is_host, ADDTIME(NOW(), :time))"
+)
+_SQL_INSERT_ROOM = text(
+    "INSERT INTO `room` "
+    "(`live_id`, `joined_user_count`, `max_user_count`, `wait_room_status`) "
+    "VALUES (:live_id, :joined_user_count, :max_user_count, :wait_room_status)"
+)
+_SQL_GET_ROOM_INFO_LIST_ALL = text(
+    "SELECT `id` as `room_id`, `live_id`, `joined_user_count`, `max_user_count` FROM `room` "
+    "WHERE `joined_user_count`<`max_user_count` and wait_room_status=1"
+)
+_SQL_GET_ROOM_INFO_LIST_LIVE = text(
+    "SELECT `id` as `room_id`, `live_id`, `joined_user_count`, `max_user_count` FROM `room` "
+    "WHERE `joined_user_count`<`max_user_count` and wait_room_status=1 and `live_id`=:live_id"
+)
+_SQL_GET_ROOM_WAIT_STATUS = text(
+    "SELECT `room`.`wait_room_status`, `room_member`.`user_id`, `user`.`name`, "
+    "`user`.`leader_card_id`, `room_member`.`select_difficulty`, "
+    "`room_member`.`user_id`=:user_id as `is_me`, `room_member`.`is_host` "
+    "FROM `room` INNER JOIN `room_member` ON `room_member`.`room_id`=`room`.`id` "
+    "INNER JOIN `user` ON `user`.`id`=`room_member`.`user_id` "
+    "WHERE `room`.`id`=:room_id"
+)
+_SQL_START_ROOM = text(
+    "UPDATE `room` INNER JOIN `room_member` ON `room_member`.`room_id`=`room`.`id` "
+    "INNER JOIN `room_member` as `me` ON `me`.`room_id`=`room`.`id` and `me`.`user_id`=:user_id "
+    "SET `room`.`wait_room_status`=:start, `room_member`.`ttl`=ADDTIME(NOW(), :time) "
+    "WHERE `room`.`id`=:room_id and `room`.`wait_room_status`=:wait"
+)
+_SQL_END_ROOM = text(
+    "UPDATE `room_member` SET `judge_count_list`=:judge_count_list, `score`=:score, "
+    "`ttl`=ADDTIME(NOW(), :time) WHERE `user_id`=:user_id and `room_id`=:room_id"
+)
+_SQL_GET_STARTED_JOINED_USER_COUNT = text(
+    "SELECT `joined_user_count` from `room` "
+    "WHERE `id`=:room_id and `wait_room_status`=:start"
+)
+_SQL_GET_RESULT_USER_LIST = text(
+    "SELECT `user_id`, `judge_count_list`, `score` FROM `room_member` "
+    "WHERE `room_id`=:room_id and `judge_count_list` IS NOT NULL and `score` IS NOT NULL"
+)
+_SQL_DELETE_ROOM_MEMBER = text(
+    "DELETE FROM `room_member` WHERE `user_id`=:user_id and `room_id`=:room_id"
+)
+# NOTE: SETは左から評価されるので、wait_room_statusはデクリメント前の値で判定する
+_SQL_DECREMENT_JOINED_USER_COUNT = text(
+    "UPDATE `room` SET "
+    "`wait_room_status`=IF(`joined_user_count`<=:count, :dissolution, `wait_room_status`), "
+    "`joined_user_count`=`joined_user_count`-:count "
+    "WHERE `id`=:room_id"
+)
+_SQL_UPDATE_ROOM_STATUS = text(
+    "UPDATE `room` SET `joined_user_count`=:joined_user_count, `wait_room_status`=:status "
+    "WHERE `id`=:room_id"
+)
+_SQL_TRANSFER_HOST = text(
+    "UPDATE `room_member` INNER JOIN "
+    "(SELECT MIN(`id`) as `id` FROM `room_member` WHERE `room_id`=:room_id HAVING MAX(`is_host`)=false) as `host` "
+    "ON `host`.`id`=`room_member`.`id` SET `room_member`.`is_host`=true"
+)
+_SQL_DELETE_ROOM_MEMBER_ALL = text("DELETE FROM `room_member` WHERE `room_id`=:room_id")
+
+
+_CREATE_USER_RETRY = 3
+_EXPIRED_MEMBER_BATCH = 4096
+
+# token -> SafeUser のプロセス内キャッシュ. update_user で破棄する.
+_USER_CACHE: TTLCache[str, "SafeUser"] = TTLCache(maxsize=10_000, ttl=60)
+_USER_CACHE_LOCK = threading.Lock()
+
+# live_id -> (_LOBBY_VERSION, room_info_list) のプロセス内キャッシュ.
+# roomの増減や人数の変化があればコミット後に _bump_lobby_version() で無効にする.
+_LOBBY_CACHE_TTL = 1.0
+_LOBBY_CACHE: TTLCache[int, tuple[int, list["RoomInfo"]]] = TTLCache(
+    maxsize=1024, ttl=_LOBBY_CACHE_TTL
+)
+_LOBBY_CACHE_LOCK = threading.Lock()
+_LOBBY_VERSION = 0
+
 
 class InvalidToken(Exception):
     """指定されたtokenが不正だったときに投げる"""
 
 
+class InvalidRoomOperation(Exception):
+    """指定されたroomに対する操作が行えなかったときに投げる"""
+
+
 class SafeUser(BaseModel):
     """token を含まないUser"""
 
@@ -29,80 +156,96 @@ class SafeUser(BaseModel):
         orm_mode = True
 
 
-def create_user(name: str, leader_card_id: int) -> str:
+async def create_user(name: str, leader_card_id: int) -> str:
     """Create new user and returns their token"""
-    token = str(uuid.uuid4())
-    # NOTE: tokenが衝突したらリトライする必要がある.
-    with engine.begin() as conn:
-        conn: Connection
-        while _get_user_by_token(conn, token) is not None:
+    # NOTE: tokenの衝突はUNIQUE KEYに任せ、IntegrityErrorならリトライする.
+    async with engine.begin() as conn:
+        conn: AsyncConnection
+        for attempt in range(_CREATE_USER_RETRY):
             token = str(uuid.uuid4())
-        result = conn.execute(
-            text(
-                "INSERT INTO `user` (`name`, `token`, `leader_card_id`) VALUES (:name, :token, :leader_card_id)"
-            ),
-            {"name": name, "token": token, "leader_card_id": leader_card_id},
-        )
-        # print(f"create_user(): id={result.lastrowid} {token=}")
-    return token
-
-
-def _get_user_by_token(conn: Connection, token: str) -> Optional[SafeUser]:
-    result = conn.execute(
-        text("SELECT `id`, `name`, `leader_card_id` FROM `user` WHERE `token`=:token"),
-        {"token": token},
-    )
+            try:
+                result = await conn.execute(
+                    _SQL_INSERT_USER,
+                    {"name": name, "token": token, "leader_card_id": leader_card_id},
+                )
+            except IntegrityError:
+                if attempt == _CREATE_USER_RETRY - 1:
+                    raise
+                continue
+            # print(f"create_user(): id={result.lastrowid} {token=}")
+            return token
+    raise AssertionError("unreachable")
+
+
+def _get_cached_user(token: str) -> Optional[SafeUser]:
+    with _USER_CACHE_LOCK:
+        return _USER_CACHE.get(token)
+
+
+async def _get_user_by_token(conn: AsyncConnection, token: str) -> Optional[SafeUser]:
+    user = _get_cached_user(token)
+    if user is not None:
+        return user
+    result = await conn.execute(_SQL_GET_USER_BY_TOKEN, {"token": token})
     row = result.one_or_none()
-    return row and SafeUser.from_orm(row)
+    user = row and SafeUser.from_orm(row)
+    if user is not None:
+        with _USER_CACHE_LOCK:
+            _USER_CACHE[token] = user
+    return user
 
 
-def _get_user_by_token_strict(conn: Connection, token: str) -> SafeUser:
-    user = _get_user_by_token(conn, token)
+async def _get_user_by_token_strict(conn: AsyncConnection, token: str) -> SafeUser:
+    user = await _get_user_by_token(conn, token)
     if user is None:
         raise InvalidToken
     return user
 
 
-def get_user_by_token(token: str) -> Optional[SafeUser]:
-    with engine.begin() as conn:
-        return _get_user_by_token(conn, token)
+async def get_user_by_token(token: str) -> Optional[SafeUser]:
+    user = _get_cached_user(token)
+    if user is not None:
+        return user
+    async with engine.begin() as conn:
+        return await _get_user_by_token(conn, token)
 
 
-def update_user(token: str, name: str, leader_card_id: int) -> None:
-    with engine.begin() as conn:
-        conn: Connection
-        result = conn.execute(
-            text(
-                "UPDATE `user` SET `name`=:name, `leader_card_id`=:leader_card_id WHERE `token`=:token"
-            ),
+async def update_user(token: str, name: str, leader_card_id: int) -> None:
+    async with engine.begin() as conn:
+        conn: AsyncConnection
+        result = await conn.execute(
+            _SQL_UPDATE_USER,
             {"name": name, "token": token, "leader_card_id": leader_card_id},
         )
         if result.rowcount != 1:
             raise InvalidToken
+    with _USER_CACHE_LOCK:
+        _USER_CACHE.pop(token, None)
 
 
 # Room API
-class LiveDifficulty(Enum):
+# NOTE: asyncmyはtype()でエスケープ方法を選ぶので、IntEnumでもbindparamには.valueを渡す
+class LiveDifficulty(IntEnum):
     NORMAL = 1
     HARD = 2
 
 
-class JoinRoomResult(Enum):
+class JoinRoomResult(IntEnum):
     OK = 1  # 入場OK
     ROOM_FULL = 2  # 満員
     DISBANDED = 3  # 解散済み
     OTHER_ERROR = 4  # その他エラー
 
 
-class WaitRoomStatus(Enum):
+class WaitRoomStatus(IntEnum):
     WATING = 1
     LIVE_START = 2
     DISSOLUTION = 3
 
 
 class RoomInfo(BaseModel):
-    room_id: str
-    live_id: str
+    room_id: int
+    live_id: int
     joined_user_count: int
     max_user_count: int
 
@@ -124,72 +267,108 @@ class RoomUser(BaseModel):
 
 class ResultUser(BaseModel):
     user_id: int
-    judge_count_list: Union[Json[list[int]], list[int]]
+    judge_count_list: list[int]
     score: int
 
     class Config:
         orm_mode = True
 
 
-class RoomMemberRecord(BaseModel):
-    id: int
-    user_id: int
-    room_id: int
-    select_difficulty: Optional[LiveDifficulty]
-    is_host: bool
-    judge_count_list: Optional[Union[Json[list[int]], list[int]]]
-    score: Optional[int]
-    ttl: Optional[datetime]
+def _bump_lobby_version():
+    global _LOBBY_VERSION
+    with _LOBBY_CACHE_LOCK:
+        _LOBBY_VERSION += 1
 
-    class Config:
-        orm_mode = True
+
+def _get_cached_room_info_list(live_id: int) -> Optional[list[RoomInfo]]:
+    with _LOBBY_CACHE_LOCK:
+        cached = _LOBBY_CACHE.get(live_id)
+        if cached is None:
+            return None
+        version, room_info_list = cached
+        if version != _LOBBY_VERSION:
+            return None
+        return room_info_list
 
 
-def _valitate_duplicate_member(conn: Connection, user_id: int, room_id: int = 0):
+async def _valitate_duplicate_member(conn: AsyncConnection, user_id: int, room_id: int):
     """
     すでに他の部屋に入っていたら退出する
     room_idは無視したい部屋(これから入る部屋)を指定する
     """
-    for (room_id,) in conn.execute(
-        text(
-            "SELECT `room_id` FROM `room_member` WHERE `user_id`=:user_id and `room_id`!=:room_id"
-        ),
-        {"user_id": user_id, "room_id": room_id},
+    for (room_id,) in await conn.execute(
+        _SQL_GET_OTHER_ROOM_ID, {"user_id": user_id, "room_id": room_id}
     ):
-        _leave_room(conn, user_id, room_id)
+        await _leave_room(conn, user_id, room_id)
 
 
-def _leave_expired_member(conn: Connection):
+async def _leave_expired_member(conn: AsyncConnection) -> int:
     """
-    TTLの切れたroom_memberレコードを削除する
+    TTLの切れたroom_memberレコードを最大_EXPIRED_MEMBER_BATCH件削除し、削除件数を返す
+    roomのjoined_user_countは部屋ごとにまとめてデクリメントする
     """
-    execute_text = text(
-        "SELECT `user_id`, `room_id` FROM `room_member` WHERE `ttl` < NOW()"
+    rows = (
+        await conn.execute(_SQL_GET_EXPIRED_MEMBER, {"limit": _EXPIRED_MEMBER_BATCH})
+    ).all()
+    if not rows:
+        return 0
+    await conn.execute(_SQL_DELETE_ROOM_MEMBER_BY_ID, {"ids": [row.id for row in rows]})
+
+    # memberのいなくなったroomはDISSOLUTIONにする
+    expired_count = Counter(row.room_id for row in rows)
+    await conn.execute(
+        _SQL_DECREMENT_JOINED_USER_COUNT,
+        [
+            {
+                "room_id": room_id,
+                "count": count,
+                "dissolution": WaitRoomStatus.DISSOLUTION.value,
+            }
+            for room_id, count in expired_count.items()
+        ],
     )
-    for (user_id, room_id) in conn.execute(execute_text):
-        _leave_room(conn, user_id, room_id)
+    return len(rows)
+
+
+async def _transfer_host_all(conn: AsyncConnection):
+    """
+    hostのいないroomのhostを移譲する
+    """
+    await conn.execute(_SQL_TRANSFER_HOST_ALL)
 
 
-def _update_member_ttl(
-    conn: Connection,
+async def _update_member_ttl(
+    conn: AsyncConnection,
     room_id: int,
-    user_id: Optional[int] = None,
+    user_id: int,
     time: timedelta = timedelta(seconds=TTL_POLLING_INTERVAL),
 ):
     """
     TTLを更新する
     """
-    conn.execute(
-        text(
-            "UPDATE `room_member` SET `ttl`=ADDTIME(NOW(), :time) "
-            f"WHERE {'' if user_id is None else '`user_id`=:user_id and '}`room_id`=:room_id"
-        ),
+    await conn.execute(
+        _SQL_UPDATE_TTL_USER,
         {"user_id": user_id, "room_id": room_id, "time": time},
     )
 
 
-def _join_room(
-    conn: Connection,
+async def _insert_room_member(conn: AsyncConnection, params: dict) -> bool:
+    """
+    room_memberをinsertする
+    user_idが衝突したらFalseを返す
+    """
+    try:
+        await conn.execute(_SQL_INSERT_ROOM_MEMBER, params)
+    except IntegrityError as e:
+        # 外部キー制約違反などはそのまま投げる
+        if e.orig.args[0] != ER.DUP_ENTRY or "uniq_member_user" not in str(e.orig):
+            raise
+        return False
+    return True
+
+
+async def _join_room(
+    conn: AsyncConnection,
     user_id: int,
     room_id: int,
     select_difficulty: LiveDifficulty,
@@ -199,66 +378,59 @@ def _join_room(
     部屋に参加する
     """
 
-    # room_memberバリテーション
-    _valitate_duplicate_member(conn, user_id, room_id)
-
-    # 参加済みチェック
-    execute_text = text(
-        "SELECT `id` FROM `room_member` WHERE `user_id`=:user_id and `room_id`=:room_id"
-    )
-    result = conn.execute(execute_text, {"user_id": user_id, "room_id": room_id})
-    if result.one_or_none() is not None:
-        return JoinRoomResult.OK
-
-    # room検索
-    room_row = conn.execute(
-        text(
-            "SELECT `id` as `room_id`, `live_id`, `joined_user_count`, `max_user_count`, `wait_room_status` "
-            "FROM `room` WHERE `id`=:room_id FOR UPDATE"
-        ),
-        {"room_id": room_id},
-    ).one()
-    status = WaitRoomStatus(room_row["wait_room_status"])
-    if status is not WaitRoomStatus.WATING:
-        return JoinRoomResult.DISBANDED
-    room_info = RoomInfo.from_orm(room_row)
-    if room_info.joined_user_count >= room_info.max_user_count:
-        return JoinRoomResult.ROOM_FULL
-
-    # joined_user_countをインクリメント
-    update_result = conn.execute(
-        text(
-            "UPDATE `room` SET `joined_user_count`=`joined_user_count`+1 WHERE `id`=:room_id"
-        ),
-        {"room_id": room_id},
+    # 待機中かつ空きがあればjoined_user_countをインクリメント
+    update_result = await conn.execute(
+        _SQL_INCREMENT_JOINED_USER_COUNT,
+        {"room_id": room_id, "wait": WaitRoomStatus.WATING.value},
     )
+    if update_result.rowcount != 1:
+        # 入れなかった理由を調べる
+        room_row = (
+            await conn.execute(
+                _SQL_GET_ROOM_CAPACITY, {"room_id": room_id, "user_id": user_id}
+            )
+        ).one()
+        if room_row.is_member:
+            return JoinRoomResult.OK
+        if room_row.wait_room_status != WaitRoomStatus.WATING:
+            return JoinRoomResult.DISBANDED
+        if room_row.joined_user_count >= room_row.max_user_count:
+            return JoinRoomResult.ROOM_FULL
+        return JoinRoomResult.OTHER_ERROR
+
     # room_memberをinsert
-    result = conn.execute(
-        text(
-            "INSERT INTO `room_member` (`user_id`, `room_id`, `select_difficulty`, `is_host`, `ttl`) "
-            "VALUES (:user_id, :room_id, :select_difficulty, :is_host, ADDTIME(NOW(), :time))"
-        ),
-        {
-            "user_id": user_id,
-            "room_id": room_id,
-            "select_difficulty": select_difficulty.value,
-            "is_host": is_host,
-            "time": timedelta(seconds=TTL_POLLING_INTERVAL),
-        },
-    )
+    # NOTE: user_idはUNIQUEなので、衝突したら他の部屋から退出して入り直す
+    params = {
+        "user_id": user_id,
+        "room_id": room_id,
+        "select_difficulty": select_difficulty.value,
+        "is_host": is_host,
+        "time": timedelta(seconds=TTL_POLLING_INTERVAL),
+    }
+    if not await _insert_room_member(conn, params):
+        await _valitate_duplicate_member(conn, user_id, room_id)
+        if not await _insert_room_member(conn, params):
+            # 参加済みだったのでインクリメントを戻す
+            await conn.execute(
+                _SQL_DECREMENT_JOINED_USER_COUNT,
+                {
+                    "room_id": room_id,
+                    "count": 1,
+                    "dissolution": WaitRoomStatus.DISSOLUTION.value,
+                },
+            )
+            return JoinRoomResult.OK
     return JoinRoomResult.OK
 
 
-def create_room(token: str, live_id: int, select_difficulty: LiveDifficulty) -> int:
-    with engine.begin() as conn:
-        conn: Connection
-        user = _get_user_by_token_strict(conn, token)
-        result = conn.execute(
-            text(
-                "INSERT INTO `room` "
-                "(`live_id`, `joined_user_count`, `max_user_count`, `wait_room_status`) "
-                "VALUES (:live_id, :joined_user_count, :max_user_count, :wait_room_status)"
-            ),
+async def create_room(
+    token: str, live_id: int, select_difficulty: LiveDifficulty
+) -> int:
+    async with engine.begin() as conn:
+        conn: AsyncConnection
+        user = await _get_user_by_token_strict(conn, token)
+        result = await conn.execute(
+            _SQL_INSERT_ROOM,
             {
                 "live_id": live_id,
                 "joined_user_count": 0,
@@ -267,220 +439,197 @@ def create_room(token: str, live_id: int, select_difficulty: LiveDifficulty) ->
             },
         )
         room_id: int = result.lastrowid
-        _join_room(conn, user.id, room_id, select_difficulty, True)
+        await _join_room(conn, user.id, room_id, select_difficulty, True)
+    _bump_lobby_version()
     return room_id
 
 
-def get_room_info_list(token: str, live_id: int) -> list[RoomInfo]:
-    with engine.begin() as conn:
-        conn: Connection
-        user = _get_user_by_token_strict(conn, token)
-        _valitate_duplicate_member(conn, user.id)
-        result = conn.execute(
-            text(
-                "SELECT `id` as `room_id`, `live_id`, `joined_user_count`, `max_user_count` FROM `room` "
-                "WHERE `joined_user_count`<`max_user_count` and wait_room_status=1"
-                f"{' and `live_id`=:live_id' if live_id else ''}"
-            ),
+async def get_room_info_list(token: str, live_id: int) -> list[RoomInfo]:
+    # NOTE: 一覧の取得では部屋の退出などの副作用を起こさない
+    room_info_list = _get_cached_room_info_list(live_id)
+    if room_info_list is not None and _get_cached_user(token) is not None:
+        return room_info_list
+
+    # NOTE: REPEATABLE READでは最初のSELECTでスナップショットが決まるので、
+    # versionはトランザクションの文より前に読む (後で読むと古い一覧が新しいversionで残る)
+    version = _LOBBY_VERSION
+    async with engine.begin() as conn:
+        conn: AsyncConnection
+        await _get_user_by_token_strict(conn, token)
+        if room_info_list is not None:
+            return room_info_list
+
+        result = await conn.execute(
+            _SQL_GET_ROOM_INFO_LIST_LIVE if live_id else _SQL_GET_ROOM_INFO_LIST_ALL,
             {"live_id": live_id},
         )
 
-        return list(map(RoomInfo.from_orm, result))
+        # NOTE: DBの値は型が揃っているのでバリデーションを省略する
+        room_info_list = [
+            RoomInfo.construct(
+                room_id=row.room_id,
+                live_id=row.live_id,
+                joined_user_count=row.joined_user_count,
+                max_user_count=row.max_user_count,
+            )
+            for row in result
+        ]
+        with _LOBBY_CACHE_LOCK:
+            _LOBBY_CACHE[live_id] = (version, room_info_list)
+        return room_info_list
 
 
-def join_room(
+async def join_room(
     token: str, room_id: int, select_difficulty: LiveDifficulty
 ) -> JoinRoomResult:
-    with engine.begin() as conn:
-        conn: Connection
-        user = _get_user_by_token_strict(conn, token)
-        join_result = _join_room(conn, user.id, room_id, select_difficulty, False)
+    async with engine.begin() as conn:
+        conn: AsyncConnection
+        user = await _get_user_by_token_strict(conn, token)
+        join_result = await _join_room(conn, user.id, room_id, select_difficulty, False)
+    _bump_lobby_version()
     return join_result
 
 
-def get_room_wait_status(
+async def get_room_wait_status(
     token: str, room_id: int
 ) -> tuple[WaitRoomStatus, list[RoomUser]]:
-    with engine.begin() as conn:
-        conn: Connection
-        user = _get_user_by_token_strict(conn, token)
+    async with engine.begin() as conn:
+        conn: AsyncConnection
+        user = await _get_user_by_token_strict(conn, token)
+
+        # roomの状態とmember一覧を1回のクエリで取得する
+        rows = (
+            await conn.execute(
+                _SQL_GET_ROOM_WAIT_STATUS, {"room_id": room_id, "user_id": user.id}
+            )
+        ).all()
+        room_user_list = [
+            RoomUser.construct(
+                user_id=row.user_id,
+                name=row.name,
+                leader_card_id=row.leader_card_id,
+                select_difficulty=LiveDifficulty(row.select_difficulty),
+                is_me=bool(row.is_me),
+                is_host=bool(row.is_host),
+            )
+            for row in rows
+        ]
 
         # memberバリテーション
-        conn.execute(
-            text(
-                "SELECT `id` FROM `room_member` WHERE `user_id`=:user_id and `room_id`=:room_id LIMIT 1"
-            ),
-            {"user_id": user.id, "room_id": room_id},
-        ).one()
-
-        status_result = conn.execute(
-            text("SELECT `wait_room_status` FROM `room` WHERE `id`=:room_id"),
-            {"room_id": room_id},
-        )
-        status = WaitRoomStatus(status_result.one()["wait_room_status"])
+        if not any(ru.is_me for ru in room_user_list):
+            raise NoResultFound
+        status = WaitRoomStatus(rows[0].wait_room_status)
 
         if status is WaitRoomStatus.WATING:
-            _update_member_ttl(
+            await _update_member_ttl(
                 conn, room_id, user.id, timedelta(seconds=TTL_POLLING_INTERVAL)
             )
-
-        member_result = conn.execute(
-            text(
-                "SELECT `user_id`, `name`, `leader_card_id`, `select_difficulty`, "
-                "`user_id`=:user_id as `is_me`, `is_host` "
-                "FROM `room_member` INNER JOIN `user` "
-                "ON `room_id`=:room_id and `room_member`.`user_id` = `user`.`id`"
-            ),
-            {"room_id": room_id, "user_id": user.id},
-        )
-        room_user_list = list(map(RoomUser.from_orm, member_result))
         return status, room_user_list
 
 
-def _get_room_member(conn: Connection, user_id: int, room_id: int):
-    return RoomMemberRecord.from_orm(
-        conn.execute(
-            text(
-                "SELECT * FROM `room_member` WHERE `user_id`=:user_id and `room_id`=:room_id"
-            ),
-            {"user_id": user_id, "room_id": room_id},
-        ).one()
-    )
-
-
-def start_room(token: str, room_id: int):
-    with engine.begin() as conn:
-        conn: Connection
-        user = _get_user_by_token_strict(conn, token)
-        member = _get_room_member(conn, user.id, room_id)
-        _update_member_ttl(conn, room_id, time=timedelta(seconds=TTL_LIVE_INTERVAL))
-        result = conn.execute(
-            text(
-                "UPDATE `room` SET `wait_room_status`=:start WHERE `id`=:room_id and `wait_room_status`=:wait"
-            ),
+async def start_room(token: str, room_id: int):
+    async with engine.begin() as conn:
+        conn: AsyncConnection
+        user = await _get_user_by_token_strict(conn, token)
+        # room_memberのTTLも同じUPDATEで延長する (`me`の結合でmemberであることも確認する)
+        result = await conn.execute(
+            _SQL_START_ROOM,
             {
                 "room_id": room_id,
+                "user_id": user.id,
                 "start": WaitRoomStatus.LIVE_START.value,
                 "wait": WaitRoomStatus.WATING.value,
+                "time": timedelta(seconds=TTL_LIVE_INTERVAL),
             },
         )
-        if result.rowcount != 1:
-            raise Exception
-
-
-def end_room(token: str, room_id: int, judge_count_list: list[int], score: int):
-    with engine.begin() as conn:
-        conn: Connection
-        user = _get_user_by_token_strict(conn, token)
-        _update_member_ttl(conn, room_id)
-        result = conn.execute(
-            text(
-                "UPDATE `room_member` SET `judge_count_list`=:judge_count_list, `score`=:score "
-                "WHERE `user_id`=:user_id and `room_id`=:room_id"
-            ),
+        # 複数テーブルUPDATEなのでroomとroom_memberの行数の合計になる
+        if result.rowcount == 0:
+            raise InvalidRoomOperation
+    _bump_lobby_version()
+
+
+async def end_room(token: str, room_id: int, judge_count_list: list[int], score: int):
+    async with engine.begin() as conn:
+        conn: AsyncConnection
+        user = await _get_user_by_token_strict(conn, token)
+        result = await conn.execute(
+            _SQL_END_ROOM,
             {
-                "judge_count_list": json.dumps(judge_count_list),
+                "judge_count_list": orjson.dumps(judge_count_list).decode(),
                 "score": score,
                 "user_id": user.id,
                 "room_id": room_id,
+                "time": timedelta(seconds=TTL_POLLING_INTERVAL),
             },
         )
         if result.rowcount != 1:
-            raise Exception
-
-
-def get_room_result(token: str, room_id: int) -> list[ResultUser]:
-    with engine.begin() as conn:
-        conn: Connection
-        user = _get_user_by_token_strict(conn, token)
-        _update_member_ttl(conn, room_id, user_id=user.id)
-        joined_user_count = conn.execute(
-            text(
-                "SELECT `joined_user_count` from `room` "
-                "WHERE `id`=:room_id and `wait_room_status`=:start"
-            ),
-            {"room_id": room_id, "start": WaitRoomStatus.LIVE_START.value},
-        ).one()["joined_user_count"]
-        result = conn.execute(
-            text(
-                "SELECT `user_id`, `judge_count_list`, `score` FROM `room_member` "
-                "WHERE `room_id`=:room_id and `judge_count_list` IS NOT NULL and `score` IS NOT NULL"
-            ),
-            {"room_id": room_id},
-        )
-        result_user_list = list(map(ResultUser.from_orm, result))
+            raise InvalidRoomOperation
+
+
+async def get_room_result(token: str, room_id: int) -> list[ResultUser]:
+    async with engine.begin() as conn:
+        conn: AsyncConnection
+        user = await _get_user_by_token_strict(conn, token)
+        await _update_member_ttl(conn, room_id, user_id=user.id)
+        room_row = (
+            await conn.execute(
+                _SQL_GET_STARTED_JOINED_USER_COUNT,
+                {"room_id": room_id, "start": WaitRoomStatus.LIVE_START.value},
+            )
+        ).one()
+        joined_user_count: int = room_row.joined_user_count
+        result = await conn.execute(_SQL_GET_RESULT_USER_LIST, {"room_id": room_id})
+        result_user_list = [
+            ResultUser.construct(
+                user_id=row.user_id,
+                judge_count_list=orjson.loads(row.judge_count_list),
+                score=row.score,
+            )
+            for row in result
+        ]
         if len(result_user_list) < joined_user_count:
             return []
         if not any(ru.user_id == user.id for ru in result_user_list):
             return []
-        _dissolution_room(conn, room_id)
+        await _dissolution_room(conn, room_id)
+    _bump_lobby_version()
     return result_user_list
 
 
-def _leave_room(conn: Connection, user_id: int, room_id: int):
-    member = RoomMemberRecord.from_orm(
-        conn.execute(
-            text(
-                "SELECT * FROM `room_member` WHERE `room_id`=:room_id and `user_id`=:user_id"
-            ),
-            {"room_id": room_id, "user_id": user_id},
-        ).one()
+async def _leave_room(conn: AsyncConnection, user_id: int, room_id: int):
+    # room_member削除
+    result = await conn.execute(
+        _SQL_DELETE_ROOM_MEMBER, {"room_id": room_id, "user_id": user_id}
     )
+    if result.rowcount != 1:
+        raise NoResultFound
 
-    # room_member削除
-    conn.execute(text("DELETE FROM `room_member` WHERE `id`=:id"), {"id": member.id})
-
-    room_row = conn.execute(
-        text(
-            "SELECT `joined_user_count`, `wait_room_status` from `room` WHERE `id`=:room_id FOR UPDATE"
-        ),
-        {"room_id": room_id},
-    ).one()
-    joined_user_count = room_row["joined_user_count"]
-    status = WaitRoomStatus(room_row["wait_room_status"])
-
-    # memberのいないroomをDISSOLUTIONにする
-    joined_user_count -= 1
-    if joined_user_count < 1:
-        status = WaitRoomStatus.DISSOLUTION
-    conn.execute(
-        text(
-            "UPDATE `room` SET `joined_user_count`=:joined_user_count, `wait_room_status`=:status "
-            "WHERE `id`=:room_id"
-        ),
+    # joined_user_countをデクリメントし、memberのいないroomをDISSOLUTIONにする
+    await conn.execute(
+        _SQL_DECREMENT_JOINED_USER_COUNT,
         {
             "room_id": room_id,
-            "joined_user_count": joined_user_count,
-            "status": status.value,
+            "count": 1,
+            "dissolution": WaitRoomStatus.DISSOLUTION.value,
         },
     )
 
-    # host移譲
-    if status != WaitRoomStatus.DISSOLUTION and member.is_host:
-        conn.execute(
-            text(
-                "UPDATE `room_member` SET `is_host`=true WHERE `room_id`=:room_id LIMIT 1"
-            ),
-            {"room_id": room_id},
-        )
+    # host移譲 (hostが残っているか、memberがいなければ何もしない)
+    await conn.execute(_SQL_TRANSFER_HOST, {"room_id": room_id})
 
 
-def leave_room(token: str, room_id: int):
-    with engine.begin() as conn:
-        conn: Connection
-        user = _get_user_by_token_strict(conn, token)
-        _leave_room(conn, user.id, room_id)
+async def leave_room(token: str, room_id: int):
+    async with engine.begin() as conn:
+        conn: AsyncConnection
+        user = await _get_user_by_token_strict(conn, token)
+        await _leave_room(conn, user.id, room_id)
+    _bump_lobby_version()
 
 
-def _dissolution_room(conn: Connection, room_id: int):
-    conn.execute(
-        text("DELETE FROM `room_member` WHERE `room_id`=:room_id"), {"room_id": room_id}
-    )
-    conn.execute(
-        text(
-            "UPDATE `room` SET `joined_user_count`=:joined_user_count, `wait_room_status`=:status "
-            "WHERE `id`=:room_id"
-        ),
+async def _dissolution_room(conn: AsyncConnection, room_id: int):
+    await conn.execute(_SQL_DELETE_ROOM_MEMBER_ALL, {"room_id": room_id})
+    await conn.execute(
+        _SQL_UPDATE_ROOM_STATUS,
         {
             "room_id": room_id,
             "joined_user_count": 0,
@@ -489,6 +638,17 @@ def _dissolution_room(conn: Connection, room_id: int):
     )
 
 
-def leave_expired_member():
-    with engine.begin() as conn:
-        _leave_expired_member(conn)
+async def leave_expired_member():
+    # 長時間ロックを持たないよう、削除はバッチ毎にコミットする
+    deleted_count = 0
+    while True:
+        async with engine.begin() as conn:
+            count = await _leave_expired_member(conn)
+        if count:
+            _bump_lobby_version()
+        deleted_count += count
+        if count < _EXPIRED_MEMBER_BATCH:
+            break
+    if deleted_count:
+        async with engine.begin() as conn:
+            await _transfer_host_all(conn)
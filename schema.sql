@@ -16,7 +16,8 @@ CREATE TABLE `room` (
   `joined_user_count` int NOT NULL DEFAULT 0,
   `max_user_count` int NOT NULL DEFAULT 0,
   `wait_room_status` int DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  INDEX `idx_room_status_live` (`wait_room_status`, `live_id`)
 );
 CREATE TABLE `room_member` (
   `id` bigint NOT NULL AUTO_INCREMENT,
@@ -30,5 +31,7 @@ CREATE TABLE `room_member` (
   FOREIGN KEY (`user_id`) REFERENCES `user` (`id`),
   FOREIGN KEY (`room_id`) REFERENCES `room` (`id`),
   PRIMARY KEY (`id`),
-  UNIQUE KEY (`user_id`)
+  UNIQUE KEY `uniq_member_user` (`user_id`),
+  INDEX `idx_member_room` (`room_id`),
+  INDEX `idx_member_ttl` (`ttl`)
 );
\ No newline at end of file
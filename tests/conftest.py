@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(scope="module", autouse=True)
+def _client_context(request):
+    # NOTE: asyncのコネクションプールはイベントループを跨げないので、
+    # 各モジュールの`client`を開いたままにし、同じイベントループで処理する
+    with request.module.client:
+        yield
@@ -1,4 +1,6 @@
+import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import text
 
 from app import model
 from app.api import app
@@ -8,7 +10,7 @@ user_tokens = []
 
 
 def _create_users():
-    for i in range(10):
+    for i in range(12):
         response = client.post(
             "/user/create",
             json={"user_name": f"room_user_{i}", "leader_card_id": 1000},
@@ -16,7 +18,9 @@ def _create_users():
         user_tokens.append(response.json()["user_token"])
 
 
-_create_users()
+@pytest.fixture(scope="module", autouse=True)
+def _users(_client_context):
+    _create_users()
 
 
 def _auth_header(i=0):
@@ -55,6 +59,25 @@ def test_room_2():
         assert join_result is model.JoinRoomResult.OK
     join_result = _test_room_join(5, room_id)
     assert join_result is model.JoinRoomResult.ROOM_FULL
+    # 満員でもmemberなら入り直せる
+    join_result = _test_room_join(2, room_id)
+    assert join_result is model.JoinRoomResult.OK
+
+
+def test_room_rejoin():
+    room_id = _test_room_create(10, live_id=1004)
+    for _ in range(2):
+        join_result = _test_room_join(11, room_id)
+        assert join_result is model.JoinRoomResult.OK
+    assert _test_room_list(10, 1004)[room_id]["joined_user_count"] == 2
+
+    # 開始後でもmemberなら入り直せる
+    response = client.post(
+        "/room/start", headers=_auth_header(10), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+    join_result = _test_room_join(11, room_id)
+    assert join_result is model.JoinRoomResult.OK
 
 
 def test_room_1():
@@ -93,6 +116,9 @@ def test_room_1():
     )
     assert response.status_code == 200
     print("room/wait response:", response.json())
+    # hostの退出後は残ったmemberにhostが移譲される
+    (me,) = [u for u in response.json()["room_user_list"] if u["is_me"]]
+    assert me["is_host"]
 
     response = client.post(
         "/room/start", headers=_auth_header(), json={"room_id": room_id}
@@ -119,3 +145,83 @@ def test_room_1():
     )
     assert response.status_code == 200
     print("room/end response:", response.json())
+
+
+def test_room_list_keeps_membership():
+    room_id = _test_room_create(6)
+
+    response = client.post("/room/list", headers=_auth_header(6), json={"live_id": 0})
+    assert response.status_code == 200
+
+    response = client.post(
+        "/room/wait", headers=_auth_header(6), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+    assert any(u["is_me"] for u in response.json()["room_user_list"])
+
+
+def _test_room_list(i, live_id):
+    response = client.post(
+        "/room/list", headers=_auth_header(i), json={"live_id": live_id}
+    )
+    assert response.status_code == 200
+    return {r["room_id"]: r for r in response.json()["room_info_list"]}
+
+
+def test_room_list_reflects_changes():
+    room_id = _test_room_create(7, live_id=1002)
+    assert _test_room_list(7, 1002)[room_id]["joined_user_count"] == 1
+
+    # 一覧のキャッシュが残っていても直後の一覧に変更が反映される
+    join_result = _test_room_join(8, room_id)
+    assert join_result is model.JoinRoomResult.OK
+    assert _test_room_list(7, 1002)[room_id]["joined_user_count"] == 2
+
+    for i in (8, 7):
+        response = client.post(
+            "/room/leave", headers=_auth_header(i), json={"room_id": room_id}
+        )
+        assert response.status_code == 200
+    assert room_id not in _test_room_list(7, 1002)
+
+
+def _expire_member(i, room_id):
+    response = client.get("/user/me", headers=_auth_header(i))
+    assert response.status_code == 200
+    user_id = response.json()["id"]
+
+    async def expire():
+        async with model.engine.begin() as conn:
+            await conn.execute(
+                text(
+                    "UPDATE `room_member` SET `ttl`=SUBTIME(NOW(), '00:01:00') "
+                    "WHERE `room_id`=:room_id and `user_id`=:user_id"
+                ),
+                {"room_id": room_id, "user_id": user_id},
+            )
+
+    # NOTE: コネクションプールと同じイベントループで実行する
+    client.portal.call(expire)
+
+
+def test_leave_expired_member():
+    room_id = _test_room_create(9, live_id=1003)
+    join_result = _test_room_join(5, room_id)
+    assert join_result is model.JoinRoomResult.OK
+
+    # hostのTTLが切れると削除され、残ったmemberにhostが移譲される
+    _expire_member(9, room_id)
+    client.portal.call(model.leave_expired_member)
+    assert _test_room_list(5, 1003)[room_id]["joined_user_count"] == 1
+
+    response = client.post(
+        "/room/wait", headers=_auth_header(5), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+    (me,) = response.json()["room_user_list"]
+    assert me["is_me"] and me["is_host"]
+
+    # memberがいなくなったroomはDISSOLUTIONになり、一覧から消える
+    _expire_member(5, room_id)
+    client.portal.call(model.leave_expired_member)
+    assert room_id not in _test_room_list(5, 1003)
@@ -1,3 +1,6 @@
+import uuid
+from unittest import mock
+
 from fastapi.testclient import TestClient
 
 from app.api import app
@@ -23,3 +26,41 @@ def test_create_user():
     assert response_data.keys() == {"id", "name", "leader_card_id"}
     assert response_data["name"] == "test1"
     assert response_data["leader_card_id"] == 1000
+
+    # /user/me でキャッシュされた後でも更新が反映される
+    response = client.post(
+        "/user/update",
+        headers={"Authorization": f"bearer {token}"},
+        json={"user_name": "test2", "leader_card_id": 2000},
+    )
+    assert response.status_code == 200
+
+    response = client.get("/user/me", headers={"Authorization": f"bearer {token}"})
+    assert response.status_code == 200
+
+    response_data = response.json()
+    assert response_data["name"] == "test2"
+    assert response_data["leader_card_id"] == 2000
+
+
+def test_create_user_retries_duplicate_token():
+    response = client.post(
+        "/user/create", json={"user_name": "test3", "leader_card_id": 1000}
+    )
+    assert response.status_code == 200
+    token = response.json()["user_token"]
+
+    # 1回目は既存のtokenと衝突させ、2回目で発行できることを確認する
+    with mock.patch(
+        "app.model.uuid.uuid4", side_effect=[uuid.UUID(token), uuid.uuid4()]
+    ):
+        response = client.post(
+            "/user/create", json={"user_name": "test4", "leader_card_id": 1000}
+        )
+    assert response.status_code == 200
+    new_token = response.json()["user_token"]
+    assert new_token != token
+
+    response = client.get("/user/me", headers={"Authorization": f"bearer {new_token}"})
+    assert response.status_code == 200
+    assert response.json()["name"] == "test4"